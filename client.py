@@ -1,11 +1,13 @@
-import datetime
+from functools import lru_cache
 import socketio
-from time import time
+from time import localtime, strftime, time
 
 def timestamp_to_datetime(unix_time):
-    return datetime.datetime.fromtimestamp(unix_time).strftime(
-        "%H:%M%:%S"
-    )
+    return _format_seconds(int(unix_time))
+
+@lru_cache(maxsize=4096)
+def _format_seconds(unix_seconds):
+    return strftime("%H:%M:%S", localtime(unix_seconds))
 
 user_name = input("\nHi :) What is your chat name? \n")
 
@@ -20,6 +22,11 @@ def response(data):
     message = data
     print(f"{message['topic']} => published: {timestamp_to_datetime(message['publish_time'])} received: {timestamp_to_datetime(time())} => {message['content']}")
 
+@sio.on("response_batch")
+def response_batch(data):
+    for message in data:
+        response(message)
+
 @sio.on("disconnect")
 def handle_disconnect():
     print(f"Session is disconnected because this user is already connected")
@@ -1,4 +1,5 @@
-import datetime
+from functools import lru_cache
+import time
 
 
 def timestamp_to_datetime(unix_time):
@@ -15,6 +16,19 @@ def timestamp_to_datetime(unix_time):
     >>> timestamp_to_datetime(1616382427)
     '03:40:27'
     """
-    return datetime.datetime.fromtimestamp(unix_time).strftime(
-        "%H:%M%:%S"
-    )
\ No newline at end of file
+    return _format_seconds(int(unix_time))
+
+
+@lru_cache(maxsize=4096)
+def _format_seconds(unix_seconds):
+    """
+    Format a whole number of seconds since the epoch as local time in the format 'HH:MM:SS'.
+    The result is cached, so the messages published within the same second are formatted only once.
+
+    Parameters:
+    - unix_seconds (int): Unix timestamp truncated to whole seconds.
+
+    Returns:
+    - str: A formatted string representing time in hours, minutes, and seconds in the format 'HH:MM:SS'.
+    """
+    return time.strftime("%H:%M:%S", time.localtime(unix_seconds))
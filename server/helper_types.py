@@ -1,5 +1,10 @@
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque
+from itertools import count
+from math import inf
 from time import time
+import heapq
 
 
 class Message:
@@ -10,15 +15,27 @@ class Message:
     - publish_time (float): The time at which the message was published. Default is the current time.
     - content (str): The content of the message. Default is an empty string.
     - pending_users (set): A set containing the names of users who have not yet received the message. Default is an empty set.
+    - removed (bool): Whether the message has already been removed from the pending messages,
+            either for good or as a tombstone left in its topic until the next compaction.
+    - _json (dict): The JSON-compatible dictionary representing the message, returned by jsonify.
+            It is set from the payload argument, or built on the first call of jsonify if no payload is given.
+
+    The payload argument of the constructor is an already built {"publish_time": ..., "content": ...} dictionary,
+    stored as _json without being copied. It is shared by every later call of jsonify, so neither the caller
+    that built it nor the callers of jsonify may modify it.
     """
 
-    def __init__(self, publish_time=time(), content="", pending_users=set()):
+    __slots__ = ("publish_time", "content", "pending_users", "removed", "_json")
+
+    def __init__(self, publish_time=None, content="", pending_users=None, payload=None):
         """
         Initialize a Message object.
         """
-        self.publish_time = publish_time
+        self.publish_time = time() if publish_time is None else publish_time
         self.content = content
-        self.pending_users = pending_users
+        self.pending_users = set() if pending_users is None else pending_users
+        self.removed = False
+        self._json = payload
 
     def remove_user(self, user_name):
         """
@@ -27,17 +44,19 @@ class Message:
         Args:
         - user_name (str): The name of the user to be removed from the list of pending users.
         """
-        if user_name in self.pending_users:
-            self.pending_users.remove(user_name)
+        self.pending_users.discard(user_name)
 
     def jsonify(self):
         """
         Convert the Message object to a JSON-compatible dictionary.
+        The dictionary is given on creation or built on the first call, and shared by all calls, so it must not be modified.
 
         Returns:
         - dict: A dictionary representing the Message object in JSON format.
         """
-        return {"publish_time": self.publish_time, "content": self.content}
+        if self._json is None:
+            self._json = {"publish_time": self.publish_time, "content": self.content}
+        return self._json
 
 
 class PendingMessages:
@@ -45,20 +64,39 @@ class PendingMessages:
     Represents a collection of pending messages.
 
     Attributes:
-    - messages (defaultdict): A dictionary containing lists of messages for each topic.
+    - messages (defaultdict): A dictionary containing deques of messages for each topic.
     - ttl (int): Time-to-live for messages, specifying how long messages are retained in the pending messages list.
+    - _publish_times (defaultdict): A dictionary containing, for each topic, a packed array of the publish times
+            of its messages, kept in the same order as the messages.
+    - _expiry_heap (list): A min-heap of (publish_time, sequence, topic, message) entries across all topics, used to expire messages.
+    - _user_topic_messages (defaultdict): A dictionary where keys are (user_name, topic) pairs
+            and values are sets of messages of the topic still pending for the user.
+    - _tombstones (defaultdict): A dictionary containing, for each topic, the set of removed messages
+            still left in its message list until the next compaction.
     """
 
-    def __init__(self, ttl=10, messages=defaultdict(list[Message])):
+    def __init__(self, ttl=10, messages=None):
         """
         Initialize a PendingMessages object.
 
         Args:
         - ttl (int): Time-to-live for messages. Default is 10 seconds.
-        - messages (defaultdict): A dictionary containing lists of messages for each topic. Default is an empty defaultdict.
+        - messages (dict): A dictionary containing iterables of messages for each topic, in the order of their arrival.
+            The messages are added one by one, so that they are indexed and expire like new messages. Default is no messages.
         """
-        self.messages = messages
+        self.messages = defaultdict(deque)
         self.ttl = ttl
+        self._publish_times = defaultdict(lambda: array("d"))  # dict[topic] = [publish_time]
+        self._expiry_heap = []
+        # The sequence number breaks publish_time ties in the heap in the order of arrival.
+        self._expiry_sequence = count()
+        self._user_topic_messages = defaultdict(set)  # dict[(user_name, topic)] = {message}
+        self._tombstones = defaultdict(set)  # dict[topic] = {message}
+
+        if messages is not None:
+            for topic, topic_messages in messages.items():
+                for msg in topic_messages:
+                    self.add_new_message(topic, msg)
 
     def __str__(self):
         """
@@ -71,7 +109,8 @@ class PendingMessages:
         for topic in self.messages:
             representation += f"Topic: {topic} \n"
             for msg in self.messages[topic]:
-                representation += f"{msg.content} \n"
+                if not msg.removed:
+                    representation += f"{msg.content} \n"
         return representation
 
     def get_topic_size(self, topic):
@@ -95,35 +134,91 @@ class PendingMessages:
         - message (Message): The message object to add to the list.
         """
         self.messages[topic].append(message)
+        self._publish_times[topic].append(message.publish_time)
+        for user_name in message.pending_users:
+            self._user_topic_messages[(user_name, topic)].add(message)
+        heapq.heappush(
+            self._expiry_heap,
+            (message.publish_time, next(self._expiry_sequence), topic, message),
+        )
 
     def remove_old_messages(self):
         """
         Remove old messages from the message lists based on the time-to-live (TTL) value.
+        Only the expired messages are visited, so the call is cheap when nothing has expired.
+        """
+        cutoff = time() - self.ttl
+
+        # The publish times of expired messages are deleted at once for each topic at the end.
+        expired_counts = defaultdict(int)  # dict[topic] = number of expired messages
+        while self._expiry_heap and self._expiry_heap[0][0] < cutoff:
+            _, _, topic, msg = heapq.heappop(self._expiry_heap)
+
+            if msg.removed:
+                # A fully transmitted message stays in its topic as a tombstone only until the next compaction.
+                tombstones = self._tombstones.get(topic)
+                if tombstones is None or msg not in tombstones:
+                    continue
+                tombstones.discard(msg)
+            else:
+                msg.removed = True
+                for user_name in msg.pending_users:
+                    self._discard_from_user_index(user_name, topic, msg)
+
+            # since the messages appended to the list in the order of their arrival,
+            # the expired message is normally the first of its topic
+            topic_messages = self.messages[topic]
+            expired_count = expired_counts[topic]
+            if topic_messages[0] is msg:
+                topic_messages.popleft()
+                expired_counts[topic] = expired_count + 1
+            else:
+                idx = topic_messages.index(msg)
+                del topic_messages[idx]
+                del self._publish_times[topic][idx + expired_count]
+
+        for topic, expired_count in expired_counts.items():
+            del self._publish_times[topic][:expired_count]
+            if len(self.messages[topic]) == 0:
+                self._drop_topic(topic)
+
+    def next_expiry(self):
+        """
+        Get the time at which the oldest pending message expires.
+
+        Returns:
+        - float: The expiration time of the oldest pending message, or infinity if there are no pending messages.
         """
-        now = time()
-        for topic in self.messages:
-            while True:
-                # since the messages appended to the list in the order of their arrival,
-                # the first is the oldest
-                if (self.get_topic_size(topic) == 0) or (
-                    self.messages[topic][0].publish_time >= (now - self.ttl)
-                ):
-                    break
-                self.messages[topic].pop(0)
+        if self._expiry_heap:
+            return self._expiry_heap[0][0] + self.ttl
+        return inf
 
     def remove_fully_transmetted_messages(self, topic):
         """
         Remove messages that have been fully transmitted to all subscribed users based on the emptyness of Message.pending_users.
+        These messages are marked as removed as soon as their last pending user is removed. They are only dropped from the topic
+        once they make up more than half of it, so that the cost of the compaction is amortized over the removals.
 
         Args:
         - topic (str): The topic from which to remove fully transmitted messages.
         """
-        clear_topic_indexes = []
-        for idx, msg in enumerate(self.messages[topic]):
-            if len(msg.pending_users) == 0:
-                clear_topic_indexes.append(idx)
-        for idx in sorted(clear_topic_indexes, reverse=True):
-            self.messages[topic].pop(idx)
+        if topic not in self.messages or len(self._tombstones.get(topic, ())) <= len(self.messages[topic]) // 2:
+            return
+
+        remaining_messages = deque()
+        remaining_publish_times = array("d")
+        for msg in self.messages[topic]:
+            if not msg.removed:
+                remaining_messages.append(msg)
+                remaining_publish_times.append(msg.publish_time)
+
+        # Drop the topic entirely once it has no pending messages left.
+        if remaining_messages:
+            self.messages[topic] = remaining_messages
+            self._publish_times[topic] = remaining_publish_times
+            self._tombstones.pop(topic, None)
+        else:
+            self._drop_topic(topic)
 
     def find_start_index(self, disconnected_time, topic):
         """
@@ -136,12 +231,15 @@ class PendingMessages:
         Returns:
         - int or None: The index of the first message after the disconnected time, or None if no such message is found.
         """
-        start_index = None
-        for idx, msg in enumerate(self.messages[topic]):
-            if msg.publish_time >= disconnected_time:
-                start_index = idx
-                break
-        return start_index
+        # since the messages appended to the list in the order of their arrival,
+        # they are sorted by publish time
+        publish_times = self._publish_times.get(topic)
+        if publish_times is None:
+            return None
+        start_index = bisect_left(publish_times, disconnected_time)
+        if start_index < len(publish_times):
+            return start_index
+        return None
 
     def get_message(self, topic, message_index):
         """
@@ -153,6 +251,7 @@ class PendingMessages:
 
         Returns:
         - Message or None: The message object at the specified index, or None if the index is out of range.
+            The message may already be removed, which is indicated by Message.removed.
         """
         if message_index >= 0 and message_index < self.get_topic_size(topic):
             return self.messages[topic][message_index]
@@ -168,7 +267,9 @@ class PendingMessages:
         - message_index (int): The index of the message in the message list.
         - user_name (str): The name of the user to remove from the pending users list.
         """
-        self.messages[topic][message_index].remove_user(user_name)
+        msg = self.messages[topic][message_index]
+        self._remove_pending_user(topic, msg, user_name)
+        self._discard_from_user_index(user_name, topic, msg)
 
     def remove_user_from_topic(self, topic, user_name):
         """
@@ -178,9 +279,49 @@ class PendingMessages:
         - topic (str): The topic from which to remove the user.
         - user_name (str): The name of the user to remove.
         """
-        for msg in self.messages[topic]:
-            if user_name in msg.pending_users:
-                msg.remove_user(user_name)
+        # Only the messages still pending for the user are visited.
+        for msg in self._user_topic_messages.pop((user_name, topic), ()):
+            self._remove_pending_user(topic, msg, user_name)
+
+    def _remove_pending_user(self, topic, message, user_name):
+        """
+        Remove a user from the pending users of a message, and mark the message as removed if it has been fully transmitted.
+
+        Args:
+        - topic (str): The topic to which the message belongs.
+        - message (Message): The message from which to remove the user.
+        - user_name (str): The name of the user to remove.
+        """
+        message.remove_user(user_name)
+        if len(message.pending_users) == 0 and not message.removed:
+            message.removed = True
+            self._tombstones[topic].add(message)
+
+    def _drop_topic(self, topic):
+        """
+        Drop a topic that has no pending messages left.
+
+        Args:
+        - topic (str): The topic to drop.
+        """
+        del self.messages[topic]
+        self._publish_times.pop(topic, None)
+        self._tombstones.pop(topic, None)
+
+    def _discard_from_user_index(self, user_name, topic, message):
+        """
+        Remove a message from the messages pending for a user in a given topic.
+
+        Args:
+        - user_name (str): The name of the user.
+        - topic (str): The topic to which the message belongs.
+        - message (Message): The message to remove.
+        """
+        key = (user_name, topic)
+        if key in self._user_topic_messages:
+            self._user_topic_messages[key].discard(message)
+            if len(self._user_topic_messages[key]) == 0:
+                del self._user_topic_messages[key]
 
 
 class Subscriptions:
@@ -258,9 +399,9 @@ class Sessions:
     A class to manage user sessions.
 
     Attributes:
-        - user_sid_to_name_sessions (defaultdict): A dictionary where keys are user session IDs
+        - user_sid_to_name_sessions (dict): A dictionary where keys are user session IDs
             and values are user names.
-        - user_name_to_sid_sessions (defaultdict): A dictionary where keys are user names
+        - user_name_to_sid_sessions (dict): A dictionary where keys are user names
             and values are user session IDs.
     """
 
@@ -268,8 +409,8 @@ class Sessions:
         """
         Initializes a Sessions object with empty dictionaries for user session mappings.
         """
-        self.user_sid_to_name_sessions = defaultdict(str)  # dict[user_sid] = user_name
-        self.user_name_to_sid_sessions = defaultdict(str)  # dict[user_name] = user_sid
+        self.user_sid_to_name_sessions = {}  # dict[user_sid] = user_name
+        self.user_name_to_sid_sessions = {}  # dict[user_name] = user_sid
 
     def get_user_name(self, user_sid):
         """
@@ -281,9 +422,7 @@ class Sessions:
         Returns:
         - str: The user name associated with the user session ID, or None if not found.
         """
-        if user_sid in self.user_sid_to_name_sessions:
-            return self.user_sid_to_name_sessions[user_sid]
-        return None
+        return self.user_sid_to_name_sessions.get(user_sid)
 
     def get_user_sid(self, user_name):
         """
@@ -295,9 +434,7 @@ class Sessions:
         Returns:
         - str: The user session ID associated with the user name, or None if not found.
         """
-        if self.is_user_connected(user_name):
-            return self.user_name_to_sid_sessions[user_name]
-        return None
+        return self.user_name_to_sid_sessions.get(user_name)
 
     def add_user(self, user_name, user_sid):
         """
@@ -330,7 +467,7 @@ class Sessions:
         Returns:
         - set: A set containing all connected user names.
         """
-        return set(self.user_name_to_sid_sessions.keys())
+        return set(self.user_name_to_sid_sessions)
 
     def is_user_connected(self, user_name):
         """
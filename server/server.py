@@ -2,6 +2,8 @@ from flask import Flask, jsonify, request
 from flask_socketio import SocketIO, disconnect, emit
 from collections import defaultdict
 import logging
+from math import inf
+import threading
 from time import time
 
 from helper_types import PendingMessages, Sessions, Subscriptions, Message
@@ -17,12 +19,39 @@ log.setLevel(logging.ERROR)
 # Time-to-live for messages, specifying how long messages are retained in the pending messages list.
 TTL = 10
 
+# Number of messages broadcast by the fanout of /publish_messages before yielding to other requests and socket events.
+BROADCAST_BATCH_SIZE = 50
+
 subscriptions = Subscriptions()
 pending_messages = PendingMessages(ttl=TTL)
 sessions = Sessions()
 
 # A dictionary containing last disconnected time of a user.
-last_disconnected_time = defaultdict(float) # dict[user_name] = disconnected_time
+last_disconnected_time = {} # dict[user_name] = disconnected_time
+
+# Guards pending_messages, together with the sessions and subscriptions the pending messages are computed from,
+# since they are updated both by the request handlers and by the background tasks.
+pending_messages_lock = threading.Lock()
+
+# Wakes up the expiry loop when a new pending message expires before the time the loop is sleeping until.
+expiry_wakeup = socketio.server.eio.create_event()
+
+
+def _expiry_loop():
+    """
+    Remove old pending messages in the background.
+
+    The loop sleeps until the oldest pending message expires, or until it is woken up by a message that expires sooner.
+    """
+    while True:
+        with pending_messages_lock:
+            delay = pending_messages.next_expiry() - time()
+        if delay > 0:
+            expiry_wakeup.wait(timeout=None if delay == inf else delay)
+            expiry_wakeup.clear()
+        with pending_messages_lock:
+            pending_messages.remove_old_messages()
+
 
 @socketio.on("start")
 def handle_start(data):
@@ -36,12 +65,28 @@ def handle_start(data):
     user_name = data["user_name"]
 
     # We support only one connected session per user_name. Checks if the user is already connected. If so, disconnects the user and returns.
-    if sessions.is_user_connected(user_name):
+    # The check is made under the lock, so that two sessions starting at the same time with the same user name cannot both pass it.
+    with pending_messages_lock:
+        already_connected = sessions.is_user_connected(user_name)
+        if not already_connected:
+            _start_session(user_name, user_sid)
+
+    # The disconnect handler takes the lock, so the session is disconnected once the lock is released.
+    if already_connected:
         disconnect()
-        return
 
-    print(f"{timestamp_to_datetime(time())} User connected: {data['user_name']}")
-    
+
+def _start_session(user_name, user_sid):
+    """
+    Connect a user: enter the rooms of their topics and send them the messages they missed.
+    Must be called with pending_messages_lock held.
+
+    Parameters:
+    - user_name (str): The name of the user.
+    - user_sid (str): The session ID of the user.
+    """
+    print(f"{timestamp_to_datetime(time())} User connected: {user_name}")
+
     # Add the user to the list of currently connected users.
     sessions.add_user(user_name, user_sid)
 
@@ -53,10 +98,10 @@ def handle_start(data):
         socketio.server.enter_room(sid=user_sid, room=topic)
 
     # Retrieve the last disconnected time for the user (if available).
-    disconnected_time = last_disconnected_time[user_name] if user_name in last_disconnected_time else 0
+    disconnected_time = last_disconnected_time.get(user_name, 0)
 
-    # Removes old messages.
-    pending_messages.remove_old_messages()
+    # Messages missed by the user, sent all at once in a single batch.
+    missed_messages = [] # [(topic, message_index, message)]
 
     for topic in topics:
 
@@ -65,15 +110,24 @@ def handle_start(data):
 
         if start_index is not None: #
             for index in range(start_index, pending_messages.get_topic_size(topic)):
-    
-                msg = pending_messages.get_message(topic, index).jsonify()
-                msg["topic"] = topic
-                emit("response", msg, to=user_sid)
 
-                # Removes the user from the list of pending users of the message after it has been sent.
-                pending_messages.remove_user_from_message(topic, index, user_name)
+                msg = pending_messages.get_message(topic, index)
+
+                # Skip the messages already transmitted to all their users, which are removed lazily.
+                if msg.removed:
+                    continue
+
+                missed_messages.append((topic, index, msg))
 
-            # Clean messages removing those that have been fully sent.
+    if len(missed_messages) != 0:
+        emit("response_batch", [{"topic": topic, **msg.jsonify()} for topic, _, msg in missed_messages], to=user_sid)
+
+        # Removes the user from the list of pending users of the messages after they have been sent.
+        for topic, index, _ in missed_messages:
+            pending_messages.remove_user_from_message(topic, index, user_name)
+
+        # Clean messages removing those that have been fully sent.
+        for topic in topics:
             pending_messages.remove_fully_transmetted_messages(topic)
 
 
@@ -83,36 +137,120 @@ def handle_disconnect():
     Handle the "disconnect" event triggered when a user disconnects.
     """
     user_sid = request.sid
-    user_name = sessions.get_user_name(user_sid)
 
-    # Updates the last disconnected time for the user.
-    last_disconnected_time[user_name] = time()
+    with pending_messages_lock:
+        user_name = sessions.get_user_name(user_sid)
 
-    # Removes the user from the list of connected users.
-    sessions.remove_user_by_sid(user_sid)
+        # Updates the last disconnected time for the user.
+        last_disconnected_time[user_name] = time()
+
+        # Removes the user from the list of connected users.
+        sessions.remove_user_by_sid(user_sid)
     print(f"{timestamp_to_datetime(time())} User disconnected: {user_name if user_name else user_sid}")
 
 
-def _get_pending_users(topic):
+def _add_pending_message(topic, message):
+    """
+    Add a message to the pending messages and wake up the expiry loop if the message is the next one to expire.
+    Must be called with pending_messages_lock held.
+
+    Parameters:
+    - topic (str): The topic to which the message belongs.
+    - message (Message): The message to add.
+    """
+    previous_expiry = pending_messages.next_expiry()
+    pending_messages.add_new_message(topic, message)
+
+    # Do not wake up the loop if it is already going to wake up sooner.
+    if pending_messages.next_expiry() < previous_expiry:
+        expiry_wakeup.set()
+
+
+def _get_pending_users(topic, all_connected):
     """
     Get the users who are subscribed to a given topic but are not currently connected.
 
     Parameters:
     - topic (str): The topic for which pending users are to be retrieved.
+    - all_connected (set): A snapshot of the names of all connected users, taken once for a whole batch of topics.
 
     Returns:
     - set: A set containing the names of users who are subscribed to the topic but are not currently connected.
     """
     all_subscribed = subscriptions.get_users(topic)
-    all_connected = sessions.get_all_connected_user_names()
     pending_users = all_subscribed - all_connected
     return pending_users
 
+
+# A FIFO queue of published messages grouped by topic, one entry per /publish_messages request.
+fanout_queue = socketio.server.eio.create_queue()
+
+
+def _fanout_worker():
+    """
+    Broadcast the published messages in the background, one request at a time in the order they were received,
+    so that the pending messages are added in the order of their publish time.
+    A request is broadcast in batches of topics, and the messages of each batch are stamped with the time they are broadcast.
+    """
+    while True:
+        contents_by_topic = fanout_queue.get()
+        try:
+            _fanout(contents_by_topic)
+        except Exception:
+            log.exception(f"Failed to broadcast messages to topics {list(contents_by_topic)}")
+
+
+def _fanout(contents_by_topic):
+    """
+    Broadcast the published messages to their topic rooms and keep them for the subscribed users who are not connected.
+
+    Parameters:
+    - contents_by_topic (dict): A dictionary where keys are topics and values are lists of message contents.
+    """
+    topics = list(contents_by_topic.items())
+    next_topic = 0
+
+    while next_topic < len(topics):
+        # The lock is held for one batch of topics at a time, so that the other handlers can run between batches.
+        with pending_messages_lock:
+            # The messages are stamped together with the snapshot of connected users: a user who disconnected before
+            # is pending and has a disconnected time older than the messages, so they are replayed on reconnection.
+            publish_time = time()
+            all_connected = sessions.get_all_connected_user_names()
+
+            broadcast = 0
+            while next_topic < len(topics) and broadcast < BROADCAST_BATCH_SIZE:
+                topic, contents = topics[next_topic]
+                next_topic += 1
+
+                # The payloads are built once, both for the broadcast and for later replays of the pending messages.
+                payloads = [{"publish_time": publish_time, "content": content} for content in contents]
+                socketio.emit("response_batch", [{"topic": topic, **payload} for payload in payloads], room=topic)
+                pending_users = _get_pending_users(topic, all_connected)
+
+                # Add the messages to pending_messages if there are some users that have not received them yet.
+                # Each message gets its own copy of the pending users, since they receive the messages one by one.
+                if len(pending_users) != 0:
+                    for payload in payloads:
+                        _add_pending_message(topic, Message(publish_time, payload["content"], set(pending_users), payload))
+
+                broadcast += len(contents)
+
+        # Let other handlers run between batches of a large broadcast, once the lock is released.
+        if next_topic < len(topics):
+            socketio.sleep(0)
+
+
 @app.route("/publish_messages", methods=["POST"])
 def publish_messages():
     """
     Publish multiple messages to their respective topics.
 
+    The messages are broadcast asynchronously: the endpoint only validates the payload, queues the messages and
+    returns 202 {"message": "Messages accepted"} before they are broadcast. The messages without a topic or content
+    are skipped, and 400 is returned if none of the messages is valid. The publish time of the messages is set
+    when they are broadcast.
+
     Example of a payload:
     {
         "messages": [
@@ -142,22 +280,21 @@ def publish_messages():
     if type(messages) != list:
         return jsonify({"error": "Object messages must be a list"}), 400
     
-    publish_time = time()
-
+    # Group the messages by topic, so that each topic room receives them in a single batch.
+    contents_by_topic = defaultdict(list) # dict[topic] = [content]
     for msg in messages:
         if "topic" in msg and "content" in msg:  
-            topic = msg["topic"]
-            content = msg["content"]
-            socketio.emit("response", {"publish_time": publish_time, "topic": topic, "content": content}, room=topic)
-            pending_users = _get_pending_users(topic)
-
-            # Add a message to pending_messages if there are some users that have not received it yet.
-            if len(pending_users) != 0:
-                pending_messages.add_new_message(topic, Message(publish_time, content, pending_users))
+            contents_by_topic[msg["topic"]].append(msg["content"])
         else:
             log.error(f"Message {msg} does not have topic or content field")
 
-    return jsonify({"message": "Messages published"}), 200
+    if len(contents_by_topic) == 0:
+        return jsonify({"error": "No message has both topic and content fields"}), 400
+
+    # The messages are broadcast in the background, so the publisher does not wait for the fanout.
+    fanout_queue.put(contents_by_topic)
+
+    return jsonify({"message": "Messages accepted"}), 202
 
 
 @app.route("/subscribe", methods=["POST"])
@@ -181,12 +318,12 @@ def subscribe():
     if type(topics) != list:
         return jsonify({"error": "Parameter topics must be a list"}), 400
 
-    for topic in topics:
-
+    with pending_messages_lock:
         # Add the user to subscriptions.
-        subscriptions.add_user(user_name, topic)
+        for topic in topics:
+            subscriptions.add_user(user_name, topic)
 
-        # If the user is connected, it should be added in the room.
+        # If the user is connected, it should be added in the rooms.
         if sessions.is_user_connected(user_name):
             user_sid = sessions.get_user_sid(user_name)
             for topic in topics:
@@ -216,24 +353,30 @@ def unsubscribe():
     if type(topics) != list:
         return jsonify({"error": "Parameter topics must be a list"}), 400
 
-    for topic in topics:
-        if topic in subscriptions.get_topics(user_name):
+    with pending_messages_lock:
+        for topic in topics:
+            if topic in subscriptions.get_topics(user_name):
 
-            # Remove the user from subscriptions and leave the topic room if he is connected.
-            subscriptions.remove_user(user_name, topic)
-            if sessions.is_user_connected(user_name):
-                user_sid = sessions.get_user_sid(user_name)
-                socketio.server.leave_room(sid=user_sid, room=topic)
+                # Remove the user from subscriptions and leave the topic room if he is connected.
+                subscriptions.remove_user(user_name, topic)
+                if sessions.is_user_connected(user_name):
+                    user_sid = sessions.get_user_sid(user_name)
+                    socketio.server.leave_room(sid=user_sid, room=topic)
 
-            # Remove the user from the pending messages and clean the pending messages from those that were transmetted to all subscribed users.
-            pending_messages.remove_user_from_topic(topic, user_name)
-            pending_messages.remove_fully_transmetted_messages(topic)
-        else:
-            log.error(f'User {user_name} is not subscribed to topic {topic}')
+                # Remove the user from the pending messages and clean the pending messages from those that were transmetted to all subscribed users.
+                pending_messages.remove_user_from_topic(topic, user_name)
+                pending_messages.remove_fully_transmetted_messages(topic)
+            else:
+                log.error(f'User {user_name} is not subscribed to topic {topic}')
 
 
     return jsonify({"message": f"Unsubscribed from the topic: {topics}"}), 200
 
 
+# The background tasks are started on import, so that they also run when the app is served or tested from another module.
+socketio.start_background_task(_expiry_loop)
+socketio.start_background_task(_fanout_worker)
+
+
 if __name__ == "__main__":
     socketio.run(app, port=8000, debug=True)
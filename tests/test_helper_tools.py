@@ -0,0 +1,34 @@
+import re
+import sys
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from helper_tools import _format_seconds, timestamp_to_datetime
+
+
+class TimestampToDatetimeTest(unittest.TestCase):
+    def setUp(self):
+        _format_seconds.cache_clear()
+
+    def test_format(self):
+        unix_time = 1616382427.25
+
+        formatted = timestamp_to_datetime(unix_time)
+
+        self.assertRegex(formatted, re.compile(r"^\d{2}:\d{2}:\d{2}$"))
+        self.assertEqual(formatted, time.strftime("%H:%M:%S", time.localtime(1616382427)))
+
+    def test_same_second_is_cached(self):
+        first = timestamp_to_datetime(1616382427.1)
+        second = timestamp_to_datetime(1616382427.9)
+
+        self.assertIs(first, second)
+        cache_info = _format_seconds.cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,221 @@
+import sys
+import unittest
+from pathlib import Path
+from time import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from helper_types import Message, PendingMessages, Sessions
+
+
+class PendingMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.pending_messages = PendingMessages(ttl=10)
+        self.now = time()
+        self.expired = self.now - 100
+
+    def add(self, topic, publish_time, content, pending_users=("bob",)):
+        msg = Message(publish_time, content, set(pending_users))
+        self.pending_messages.add_new_message(topic, msg)
+        return msg
+
+    def contents(self, topic):
+        return [msg.content for msg in self.pending_messages.messages[topic] if not msg.removed]
+
+    def assert_publish_times_consistent(self, topic):
+        self.assertEqual(
+            list(self.pending_messages._publish_times[topic]),
+            [msg.publish_time for msg in self.pending_messages.messages[topic]],
+        )
+
+    def test_remove_old_messages_keeps_fresh_messages(self):
+        self.add("food", self.expired, "Apples")
+        self.add("food", self.now, "Pears")
+        self.add("news", self.expired, "Paris")
+
+        self.pending_messages.remove_old_messages()
+
+        self.assertEqual(self.contents("food"), ["Pears"])
+        self.assertNotIn("news", self.pending_messages.messages)
+        self.assert_publish_times_consistent("food")
+        self.assertEqual(self.pending_messages.next_expiry(), self.now + 10)
+
+    def test_remove_old_messages_clears_user_index(self):
+        self.add("food", self.expired, "Apples")
+
+        self.pending_messages.remove_old_messages()
+
+        self.assertEqual(len(self.pending_messages._user_topic_messages), 0)
+        self.assertEqual(self.pending_messages.next_expiry(), float("inf"))
+
+    def test_remove_old_messages_out_of_order(self):
+        self.add("food", self.now, "Pears")
+        self.add("food", self.expired, "Apples")
+
+        self.pending_messages.remove_old_messages()
+
+        self.assertEqual(self.contents("food"), ["Pears"])
+        self.assert_publish_times_consistent("food")
+
+    def test_fully_transmitted_message_is_a_tombstone_until_compaction(self):
+        self.add("food", self.now, "Apples")
+        self.add("food", self.now, "Pears")
+        self.add("food", self.now, "Figs")
+
+        self.pending_messages.remove_user_from_message("food", 0, "bob")
+        self.pending_messages.remove_fully_transmetted_messages("food")
+
+        self.assertEqual(self.pending_messages.get_topic_size("food"), 3)
+        self.assertTrue(self.pending_messages.get_message("food", 0).removed)
+        self.assertEqual(self.contents("food"), ["Pears", "Figs"])
+
+    def test_compaction_once_most_messages_are_removed(self):
+        self.add("food", self.now, "Apples")
+        self.add("food", self.now, "Pears", ("bob", "alice"))
+        self.add("food", self.now, "Figs")
+
+        self.pending_messages.remove_user_from_topic("food", "bob")
+        self.pending_messages.remove_fully_transmetted_messages("food")
+
+        self.assertEqual(self.pending_messages.get_topic_size("food"), 1)
+        self.assertEqual(self.contents("food"), ["Pears"])
+        self.assert_publish_times_consistent("food")
+
+        self.pending_messages.remove_user_from_topic("food", "alice")
+        self.pending_messages.remove_fully_transmetted_messages("food")
+
+        self.assertNotIn("food", self.pending_messages.messages)
+
+    def test_remove_user_from_topic_leaves_other_topics(self):
+        self.add("food", self.now, "Apples")
+        self.add("news", self.now, "Paris")
+
+        self.pending_messages.remove_user_from_topic("food", "bob")
+
+        self.assertEqual(self.contents("food"), [])
+        self.assertEqual(self.contents("news"), ["Paris"])
+
+    def test_expired_tombstone_is_removed(self):
+        tombstone = self.add("food", self.expired, "Apples")
+        self.add("food", self.now, "Pears")
+        self.add("food", self.now, "Figs")
+
+        self.pending_messages.remove_user_from_message("food", 0, "bob")
+        self.pending_messages.remove_old_messages()
+
+        self.assertNotIn(tombstone, self.pending_messages.messages["food"])
+        self.assertEqual(len(self.pending_messages._tombstones["food"]), 0)
+        self.assert_publish_times_consistent("food")
+
+    def test_expired_tombstone_out_of_order_is_removed(self):
+        self.add("food", self.now, "Pears")
+        self.add("food", self.now, "Figs")
+        tombstone = self.add("food", self.expired, "Apples")
+
+        self.pending_messages.remove_user_from_message("food", 2, "bob")
+        self.pending_messages.remove_old_messages()
+
+        self.assertNotIn(tombstone, self.pending_messages.messages["food"])
+        self.assertEqual(self.contents("food"), ["Pears", "Figs"])
+        self.assert_publish_times_consistent("food")
+
+    def test_expired_message_after_compaction(self):
+        self.add("food", self.expired, "Apples")
+        self.add("food", self.expired, "Pears", ("alice",))
+
+        self.pending_messages.remove_user_from_topic("food", "bob")
+        self.pending_messages.remove_fully_transmetted_messages("food")
+        self.pending_messages.remove_old_messages()
+
+        self.assertNotIn("food", self.pending_messages.messages)
+        self.assertEqual(len(self.pending_messages._expiry_heap), 0)
+
+    def test_find_start_index_after_compaction(self):
+        for i in range(4):
+            self.add("food", self.now + i, str(i), ("bob",) if i < 3 else ("alice",))
+
+        self.pending_messages.remove_user_from_topic("food", "bob")
+        self.pending_messages.remove_fully_transmetted_messages("food")
+
+        self.assertEqual(self.pending_messages.find_start_index(self.now, "food"), 0)
+        self.assertEqual(self.pending_messages.get_message("food", 0).content, "3")
+        self.assertIsNone(self.pending_messages.find_start_index(self.now + 4, "food"))
+
+    def test_find_start_index(self):
+        for i in range(3):
+            self.add("food", self.now + i, str(i))
+
+        self.assertEqual(self.pending_messages.find_start_index(self.now - 1, "food"), 0)
+        self.assertEqual(self.pending_messages.find_start_index(self.now + 0.5, "food"), 1)
+        self.assertEqual(self.pending_messages.find_start_index(self.now + 2, "food"), 2)
+        self.assertIsNone(self.pending_messages.find_start_index(self.now + 3, "food"))
+        self.assertIsNone(self.pending_messages.find_start_index(self.now, "news"))
+
+    def test_find_start_index_does_not_create_topics(self):
+        self.assertIsNone(self.pending_messages.find_start_index(self.now, "news"))
+
+        self.assertNotIn("news", self.pending_messages._publish_times)
+        self.assertNotIn("news", self.pending_messages.messages)
+
+    def test_constructor_messages_are_indexed(self):
+        msg = Message(self.expired, "Apples", {"bob"})
+        pending_messages = PendingMessages(ttl=10, messages={"food": [msg]})
+
+        self.assertEqual(pending_messages.find_start_index(0, "food"), 0)
+        pending_messages.remove_old_messages()
+
+        self.assertNotIn("food", pending_messages.messages)
+        self.assertEqual(len(pending_messages._user_topic_messages), 0)
+
+
+class MessageTest(unittest.TestCase):
+    def test_default_pending_users_are_not_shared(self):
+        first = Message()
+        second = Message()
+        first.pending_users.add("bob")
+
+        self.assertEqual(second.pending_users, set())
+
+    def test_jsonify(self):
+        msg = Message(1.0, "Apples")
+
+        self.assertEqual(msg.jsonify(), {"publish_time": 1.0, "content": "Apples"})
+        self.assertIs(msg.jsonify(), msg.jsonify())
+
+
+
+class SessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.sessions = Sessions()
+        self.sessions.add_user("bob", "sid-bob")
+
+    def test_lookups(self):
+        self.assertEqual(self.sessions.get_user_name("sid-bob"), "bob")
+        self.assertEqual(self.sessions.get_user_sid("bob"), "sid-bob")
+        self.assertTrue(self.sessions.is_user_connected("bob"))
+        self.assertEqual(self.sessions.get_all_connected_user_names(), {"bob"})
+
+    def test_unknown_lookups_do_not_add_entries(self):
+        self.assertIsNone(self.sessions.get_user_name("sid-alice"))
+        self.assertIsNone(self.sessions.get_user_sid("alice"))
+        self.assertFalse(self.sessions.is_user_connected("alice"))
+
+        self.assertEqual(self.sessions.user_sid_to_name_sessions, {"sid-bob": "bob"})
+        self.assertEqual(self.sessions.user_name_to_sid_sessions, {"bob": "sid-bob"})
+
+    def test_remove_user_by_sid(self):
+        self.sessions.remove_user_by_sid("sid-bob")
+        self.sessions.remove_user_by_sid("sid-unknown")
+
+        self.assertFalse(self.sessions.is_user_connected("bob"))
+        self.assertEqual(self.sessions.user_sid_to_name_sessions, {})
+        self.assertEqual(self.sessions.user_name_to_sid_sessions, {})
+
+    def test_connected_user_names_is_a_snapshot(self):
+        connected = self.sessions.get_all_connected_user_names()
+        self.sessions.add_user("alice", "sid-alice")
+
+        self.assertEqual(connected, {"bob"})
+
+if __name__ == "__main__":
+    unittest.main()